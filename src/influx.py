@@ -1,53 +1,167 @@
+import atexit
 import logging
-from typing import Any, Dict
+import time
+from typing import Any, Dict, List
 
 import influxdb.exceptions as inexc
 from influxdb import InfluxDBClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def _escape(name: str, special: str) -> str:
+    """
+    Escape backslashes and the given special characters for line protocol.
+    """
+
+    name = name.replace("\\", "\\\\")
+    for char in special:
+        name = name.replace(char, f"\\{char}")
+    return name
+
+
+def _format_value(value: Any) -> str:
+    """
+    Format a field value for line protocol.
+    """
+
+    # bool is a subclass of int and must be checked first
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _to_line(measurement: str, fields: Dict[str, Any], timestamp: int) -> str:
+    """
+    Convert a measurement with its fields and a timestamp in nanoseconds to a line protocol string.
+    """
+
+    fields = ",".join(f"{_escape(key, ',= ')}={_format_value(value)}" for key, value in fields.items())
+    return f"{_escape(measurement, ', ')} {fields} {timestamp}"
 
 
 class Influx:
-    def __init__(self, ip: str, port: int, user: str, password: str, db_name: str, debug: bool = False) -> None:
+    # flush the buffered points once this many have accumulated ...
+    BATCH_SIZE = 100
+    # ... or once this many seconds have passed since the last flush
+    FLUSH_INTERVAL = 300
+
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        user: str,
+        password: str,
+        db_name: str,
+        debug: bool = False,
+        batch_size: int = BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+    ) -> None:
 
         self.logger = logging.getLogger("Influx")
-        self.client = InfluxDBClient(host=ip, port=port, username=user, password=password)
+        # retries are handled by the adapter below only (retries=1 is a single attempt of the client itself),
+        # a failing write gives up after about 7 s, well inside the 10 s docker grants to flush on stop
+        self.client = InfluxDBClient(host=ip, port=port, username=user, password=password, retries=1, timeout=(1, 4))
+        # keep a single connection to InfluxDB alive for the lifetime of the program
+        self.client._session.mount(
+            "http://",
+            HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=Retry(total=2, read=0, backoff_factor=0.25)),
+        )
         self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
         self.DEBUG = debug
 
+        self._buffer: List[str] = []
+        self._last_flush = time.monotonic()
+
         if self.DEBUG:
             self.logger.setLevel("DEBUG")
 
-        # create new database if necessary
-        if not self.db_name in [db["name"] for db in self.client.get_list_database()]:
+        # create new database if necessary, CREATE DATABASE does nothing if the database exists already
+        try:
             self.client.create_database(self.db_name)
-            self.logger.info(f"Created new database {self.db_name} because it did not exist yet.")
+            self.logger.debug(f"Ensured that database {self.db_name} exists.")
+        except inexc.InfluxDBClientError as e:
+            # creating databases requires admin privileges, users with write access only rely on an existing database
+            if e.code != 403:
+                raise
+            self.logger.warning("Not allowed to create database %s, assuming it exists: %s", self.db_name, e)
 
         # select current database
         self.client.switch_database(self.db_name)
 
-    def write(self, data: Dict[str, Any]) -> None:
+        # do not lose buffered points on shutdown
+        atexit.register(self.flush)
+
+    def write(self, data: List[Dict[str, Any]]) -> bool:
         """
-        Write the data to the database.
+        Add the data to the write buffer and flush the buffer to the database
+        if it is full or has not been flushed for too long.
+        Call this regularly, also without new data, to flush the buffer in time.
 
         Parameters
         ----------
-        data : Dict[str, Any]
-            Data dictionary in the form
+        data : List[Dict[str, Any]]
+            List of data dictionaries in the form
             {'measurement: ..., 'time': ..., fields: {...}}
 
-        Raises
-        ------
-        ConnectionError
-            Raised if the client cannot be reached.
+        Returns
+        -------
+        bool
+            True if the buffer including the data was written to the database.
         """
+        for point in data:
+            # fields without a value are not sent, line protocol cannot represent them
+            fields = {key: value for key, value in point["fields"].items() if value is not None}
+            # line protocol requires a measurement and at least one field
+            if not point["measurement"] or not fields:
+                self.logger.debug(f"Skipping point without measurement or fields: {point}")
+                continue
+            self._buffer.append(_to_line(point["measurement"], fields, point["time"]))
+        if data:
+            self.logger.debug(f"Buffered points: {data}")
+
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            return self.flush()
+        return False
+
+    def flush(self) -> bool:
+        """
+        Write all buffered points to the database.
+        Errors are logged and not raised. If the database could not be reached, the points stay buffered
+        and are retried on the next flush. Points the database rejects are dropped.
+
+        Returns
+        -------
+        bool
+            True if the buffered points were written to the database.
+        """
+        if not self._buffer:
+            return False
+
         try:
-            self.logger.debug(f"Writing points: {data}")
-            iresponse = self.client.write_points(data)
+            self.logger.debug(f"Writing {len(self._buffer)} points.")
+            iresponse = self.client.write_points(self._buffer, batch_size=5000, time_precision="n", protocol="line")
             self.logger.debug(f"InfuxDB response: {iresponse}")
             if not iresponse:
                 raise ConnectionError("Sending data to database failed.", iresponse)
+            self._buffer.clear()
+            self._last_flush = time.monotonic()
+            return True
         except ConnectionError as e:
-            self.logger.error("Connection Error.\n", e)
+            self.logger.error("Connection Error: %s", e)
         except inexc.InfluxDBServerError as e:
-            self.logger.error("Sending data to database failed due to timeout.\n", e)
+            self.logger.error("Sending data to database failed due to timeout: %s", e)
+        except inexc.InfluxDBClientError as e:
+            # the database rejected the points, sending them again will not help
+            self.logger.error("Database rejected the points, dropping them: %s", e)
+            self._buffer.clear()
+            self._last_flush = time.monotonic()
         except Exception as e:
-            self.logger.error("Encountered unknown error.\n", e)
+            self.logger.error("Encountered unknown error: %s", e)
+        return False
@@ -1,10 +1,110 @@
+import asyncio
 import logging
-import subprocess
-from datetime import datetime
+import re
+import time
 from typing import Any, Dict, Optional
 
-import requests
-from requests.exceptions import Timeout
+import aiohttp
+from selectolax.lexbor import LexborHTMLParser
+from tenacity import retry, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_exponential
+
+
+def _str_or_none(value: str) -> Optional[str]:
+    """
+    Return None if the value is an empty string or otherwise the stripped string.
+    """
+
+    return value.strip() or None
+
+
+def _int_or_none(value: str) -> Optional[int]:
+    """
+    Return None if the value is not a number or otherwise cast to int.
+    A trailing percent sign as used for the signal quality is ignored.
+    """
+
+    value = value.rstrip("%")
+    return int(value) if value.isdigit() else None
+
+
+def _float_or_none(value: str) -> Optional[float]:
+    """
+    Return None if the value is not a number or otherwise cast to float.
+    """
+
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _bool_or_none(value: str) -> Optional[bool]:
+    """
+    Return None if the value is an empty string or otherwise cast the 0/1 flag to bool.
+    """
+
+    return bool(int(value)) if value else None
+
+
+def _is_empty(influx_data: Optional[list]) -> bool:
+    """
+    Test if the inverter answered successfully but returned only empty fields.
+    Failed requests, e.g. due to a wrong password, are not considered empty as retrying them does not help.
+    """
+
+    if influx_data is None:
+        return False
+    fields = influx_data[0]["fields"]
+    return fields["request_status_code"] == 200 and fields.get("yield_total") is None
+
+
+# measure name, javascript variable in the web interface, converter for the value
+_FIELDS = [
+    ("inverter_serial_number", "webdata_sn", _str_or_none),
+    ("firmware_main", "webdata_msvn", _str_or_none),
+    ("firmware_slave", "webdata_ssvn", _str_or_none),
+    ("inverter_model", "webdata_pv_type", _str_or_none),
+    ("power_rated", "webdata_rate_p", _int_or_none),
+    ("power_current", "webdata_now_p", _int_or_none),
+    ("yield_today", "webdata_today_e", _float_or_none),
+    ("yield_total", "webdata_total_e", _float_or_none),
+    ("alerts", "webdata_alarm", _str_or_none),
+    ("last_updated", "webdata_utime", _int_or_none),
+    ("device_serial_number", "cover_mid", _str_or_none),
+    ("firmware_version", "cover_ver", _str_or_none),
+    ("WiFi_mode", "cover_wmode", _str_or_none),
+    ("AP_SSID", "cover_ap_ssid", _str_or_none),
+    ("AP_IP", "cover_ap_ip", _str_or_none),
+    ("AP_mac", "cover_ap_mac", _str_or_none),
+    ("STA_SSID", "cover_sta_ssid", _str_or_none),
+    ("STA_signal_quality", "cover_sta_rssi", _int_or_none),
+    ("STA_IP", "cover_sta_ip", _str_or_none),
+    ("STA_mac", "cover_sta_mac", _str_or_none),
+    ("remote_server_A_connected", "status_a", _bool_or_none),
+    ("remote_server_B_connected", "status_b", _bool_or_none),
+    ("remote_server_C_connected", "status_c", _bool_or_none),
+]
+
+# fields that change between samples, all others describe the inverter and are only sent once
+_DYNAMIC_NAMES = {
+    "power_current",
+    "yield_today",
+    "yield_total",
+    "alerts",
+    "last_updated",
+    "STA_signal_quality",
+    "remote_server_A_connected",
+    "remote_server_B_connected",
+    "remote_server_C_connected",
+}
+_DYNAMIC_FIELDS = [field for field in _FIELDS if field[0] in _DYNAMIC_NAMES]
+
+# declarations of the known javascript variables in the inverter web interface, e.g. 'var webdata_now_p = "123";'
+_VAR_RE = re.compile(
+    # quoted values may contain semicolons, unquoted values end at the first one
+    r"^var (" + "|".join(key for _, key, _ in _FIELDS) + r')\s*=\s*(?:"([^"\r\n]*)"|([^;\r\n]*?))\s*;',
+    re.M,
+)
 
 
 class MI300:
@@ -14,6 +114,7 @@ class MI300:
         user: str,
         password: str,
         debug: bool = False,
+        keepalive_timeout: float = 120,
     ) -> None:
         self.logger = logging.getLogger("MI300")
         self.ip = ip
@@ -22,171 +123,136 @@ class MI300:
         self.influx_data: Optional[list] = None
         self.DEBUG = debug
 
+        # static inverter fields, parsed from the first successful read only
+        # and sent with every sample until they have been written to the database
+        self._static_fields: Dict[str, Any] = {}
+        self._static_written = False
+
+        # keep one session for the lifetime of the inverter to reuse the connection across samples,
+        # the idle connection has to outlive the time between samples to be reused at all
+        self._session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(self.user, self.passwd),
+            timeout=aiohttp.ClientTimeout(total=2),
+            connector=aiohttp.TCPConnector(limit=1, keepalive_timeout=keepalive_timeout),
+        )
+
         if self.DEBUG:
             self.logger.setLevel("DEBUG")
 
-    def is_reachable(self) -> None:
+    async def close(self) -> None:
         """
-        Ping the inverter to test if it is online.
-        The inverter shuts down when the panel output is too low to save power.
+        Close the connection to the inverter.
         """
 
-        command = ["ping", "-c", "1", self.ip]
-        self.is_reachable = subprocess.call(command) == 0
-
-        return self.is_reachable
+        await self._session.close()
 
-    def query(self) -> None:
+    async def query(self) -> None:
         """
         Connect to the inverter and read data from it.
         """
 
-        self.get_html()
+        await self.get_html()
         self.parse_html()
 
-    def read_data(self) -> None:
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(min=0.5, max=8),
+        # the inverter may have dropped the idle keep-alive connection in the meantime
+        retry=retry_if_result(_is_empty) | retry_if_exception_type(aiohttp.ServerDisconnectedError),
+        retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+    )
+    async def _read_once(self) -> Optional[list]:
+        """
+        Read data from the inverter once and return it.
+        """
+
+        await self.query()
+        return self.influx_data
+
+    async def read_data(self) -> None:
         """
-        Read data from the inverter. Retry if no data is returned.
+        Read data from the inverter. Retry with exponential backoff if no data is returned.
         Occasionally only empty fields are returned by the inverter.
         """
 
-        tries = 0
-        while tries < 5:
-            self.query()
-            if self.influx_data[0]["fields"]["yield_total"] is not None:
-                break
+        await self._read_once()
 
-    def get_html(self) -> None:
+    async def get_html(self) -> None:
         """
         Connect to the inverter and obtain the web interface.
+        The inverter shuts down when the panel output is too low to save power, it is then treated as off-line.
         """
 
-        self.time = datetime.utcnow()
+        self.time = time.time_ns()
+        start = time.perf_counter()
         try:
-            request = requests.get(
-                f"http://{self.ip}/status.html",
-                verify=False,
-                auth=(self.user, self.passwd),
-                timeout=2,
-            )
-        except Timeout:
-            self.logger.debug("Request to inverter web interface timed out.")
+            async with self._session.get(f"http://{self.ip}/status.html") as request:
+                self.request_status_code = request.status
+                self.request_reason = request.reason
+                if request.status == 200:
+                    # like requests, fall back to ISO-8859-1 if the inverter does not declare a charset
+                    self.request_html = await request.text(encoding=request.charset or "iso-8859-1", errors="replace")
+                else:
+                    self.request_html = None
+                    self.logger.debug(f"Request failed. Status code: {request.status}. Reason: {request.reason}")
+            self.request_elapsed = time.perf_counter() - start
+        except (aiohttp.ClientConnectorError, asyncio.TimeoutError) as e:
+            self.logger.debug(f"Inverter {self.ip} is off-line or did not answer: {e}")
             self.request_status_code = None
             self.request_reason = None
             self.request_elapsed = None
             self.request_html = None
-        else:
-            self.request_status_code = request.status_code
-            self.request_reason = request.reason
-            self.request_elapsed = request.elapsed
-            if request.status_code == 200:
-                self.request_html = request.text
-            else:
-                self.request_html = None
-                self.logger.debug(f"Request failed. Status code: {request.status_code}. Reason: {request.reason}")
-        finally:
-            request.close()
-
-    def _value_or_none(self, value: Any, dtype: type = str) -> Optional[int | float | bool]:
-        """
-        Return None if the value is an empty string or otherwise cast to the given type.
-        """
-
-        if dtype == str:
-            return value.strip() if value else None
-        if dtype == int:
-            return int(value) if value.isdigit() else None
-        if dtype == float:
-            try:
-                return float(value)
-            except ValueError:
-                return None
-        if dtype == bool:
-            return bool(int(value)) if value else None
-        else:
-            raise TypeError(f"Type '{dtype}' is not implemented.")
 
     def parse_html(self) -> None:
         """
         Decode the web interface html and parse the values of interest.
+        Static fields such as serial numbers and firmware versions are only parsed on the first successful read
+        and only sent until they have been written to the database, see `confirm_written`.
         """
 
         if self.request_status_code is None:
             self.influx_data = None
         else:
-            if self.request_status_code != 200:
-                measure_names = [
-                    "inverter_serial_number",
-                    "firmware_main",
-                    "firmware_slave",
-                    "inverter_model",
-                    "power_rated",
-                    "power_current",
-                    "yield_today",
-                    "yield_total",
-                    "alerts",
-                    "last_updated",
-                    "device_serial_number",
-                    "firmware_version",
-                    "WiFi_mode",
-                    "AP_SSID",
-                    "AP_IP",
-                    "AP_mac",
-                    "STA_SSID",
-                    "STA_signal_quality",
-                    "STA_IP",
-                    "STA_mac",
-                    "remote_server_A_connected",
-                    "remote_server_B_connected",
-                    "remote_server_C_connected",
-                ]
-                measures = {k: None for k in measure_names}
-                measures["request_status_code"] = self.request_status_code
-                measures["request_reason"] = self.request_reason
-                measures["request_elapsed"] = self.request_elapsed.total_seconds()
-
-            else:
-                html = self.request_html.split("\r\n")
-                js_vars = [
-                    line.strip("var ").strip(";")
-                    for line in html
-                    if line.startswith("var web") or line.startswith("var cover") or line.startswith("var status")
-                ]
-                js_vars = [v.split(" = ") for v in js_vars]
-                js_vars = {v[0]: v[1].strip('"') for v in js_vars}
-                measures = {
-                    "request_status_code": self.request_status_code,
-                    "request_reason": self.request_reason,
-                    "request_elapsed": self.request_elapsed.total_seconds(),
-                    "inverter_serial_number": self._value_or_none(js_vars["webdata_sn"]),
-                    "firmware_main": self._value_or_none(js_vars["webdata_msvn"]),
-                    "firmware_slave": self._value_or_none(js_vars["webdata_ssvn"]),
-                    "inverter_model": self._value_or_none(js_vars["webdata_pv_type"]),
-                    "power_rated": self._value_or_none(js_vars["webdata_rate_p"], dtype=int),
-                    "power_current": self._value_or_none(js_vars["webdata_now_p"], dtype=int),
-                    "yield_today": self._value_or_none(js_vars["webdata_today_e"], dtype=float),
-                    "yield_total": self._value_or_none(js_vars["webdata_total_e"], dtype=float),
-                    "alerts": self._value_or_none(js_vars["webdata_alarm"]),
-                    "last_updated": self._value_or_none(js_vars["webdata_utime"], dtype=int),
-                    "device_serial_number": self._value_or_none(js_vars["cover_mid"]),
-                    "firmware_version": self._value_or_none(js_vars["cover_ver"]),
-                    "WiFi_mode": self._value_or_none(js_vars["cover_wmode"]),
-                    "AP_SSID": self._value_or_none(js_vars["cover_ap_ssid"]),
-                    "AP_IP": self._value_or_none(js_vars["cover_ap_ip"]),
-                    "AP_mac": self._value_or_none(js_vars["cover_ap_mac"]),
-                    "STA_SSID": self._value_or_none(js_vars["cover_sta_ssid"]),
-                    "STA_signal_quality": self._value_or_none(js_vars["cover_sta_rssi"].strip("%"), dtype=int),
-                    "STA_IP": self._value_or_none(js_vars["cover_sta_ip"]),
-                    "STA_mac": self._value_or_none(js_vars["cover_sta_mac"]),
-                    "remote_server_A_connected": self._value_or_none(js_vars["status_a"], dtype=bool),
-                    "remote_server_B_connected": self._value_or_none(js_vars["status_b"], dtype=bool),
-                    "remote_server_C_connected": self._value_or_none(js_vars["status_c"], dtype=bool),
-                }
+            measures = {
+                "request_status_code": self.request_status_code,
+                "request_reason": self.request_reason,
+                "request_elapsed": self.request_elapsed,
+            }
+
+            if self.request_status_code == 200:
+                tree = LexborHTMLParser(self.request_html)
+                scripts = "\n".join(node.text() for node in tree.css("script"))
+                js_vars = {key: quoted or unquoted for key, quoted, unquoted in _VAR_RE.findall(scripts)}
+                for name, key, convert in _DYNAMIC_FIELDS if self._static_fields else _FIELDS:
+                    measures[name] = convert(js_vars.get(key, ""))
+
+                # only cache complete reads, the inverter occasionally returns empty fields (see _is_empty)
+                if (
+                    not self._static_fields
+                    and measures["inverter_serial_number"] is not None
+                    and measures["yield_total"] is not None
+                ):
+                    self._static_fields = {name: measures[name] for name, _, _ in _FIELDS if name not in _DYNAMIC_NAMES}
+
+            if not self._static_written:
+                measures.update(self._static_fields)
 
             self.influx_data = [
                 {
-                    "measurement": measures["inverter_serial_number"],
+                    "measurement": self._static_fields.get("inverter_serial_number")
+                    or measures.get("inverter_serial_number"),
                     "time": self.time,
                     "fields": measures,
                 }
             ]
+
+    def confirm_written(self, data: list) -> None:
+        """
+        Stop sending the static fields once a point of this inverter containing them has been written to the database.
+        """
+
+        serial = self._static_fields.get("inverter_serial_number")
+        if serial is not None and any(
+            point["measurement"] == serial and "inverter_serial_number" in point["fields"] for point in data
+        ):
+            self._static_written = True
@@ -7,9 +7,9 @@ Author: GiantMolecularCloud
 Version: 0.1
 
 This script uses environment variables for authentification and settings:
-INVERTER_IP     IP address of the Bosswerk MI300 (or compatible) inverter
-INVERTER_USER   user to access the inverter web interface
-INVERTER_PASSWD password to access the inverter web interface
+INVERTER_IP     IP address of the Bosswerk MI300 (or compatible) inverter, separate multiple inverters by commas
+INVERTER_USER   user to access the inverter web interface, shared by all inverters
+INVERTER_PASSWD password to access the inverter web interface, shared by all inverters
 INFLUX_IP       IP address of the machine InfluxDB is running on, default: 127.0.0.1
 INFLUX_PORT     port to connect to InfluxDB, default: 8086
 INFLUX_USER     user to access the InfluxDB database, default: root
@@ -17,12 +17,17 @@ INFLUX_PASSWD   password to access the InfluxDB database, default: root
 DB_NAME         Database to write the measurements to, default: solarpower
 TIMEZONE        Timezone of assume for the time, default: Europe/Berlin
 SAMPLE_TIME     time to wait before getting the next sample, default: 60
+BATCH_SIZE      number of samples to buffer before writing them to InfluxDB, default: 100
+FLUSH_INTERVAL  maximum time in seconds to buffer samples before writing them to InfluxDB, default: 300
 DEBUG           Wether to enable debug messages, default: False
 """
 
+import asyncio
 import logging
 import os
-import time
+import signal
+import sys
+from typing import List
 
 from influx import Influx
 from mi300 import MI300
@@ -32,7 +37,7 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s -  %(name)s - %(leve
 logger = logging.getLogger("main")
 
 # inverter settings
-INVERTER_IP = os.getenv("INVERTER_IP")
+INVERTER_IPS = [ip.strip() for ip in os.getenv("INVERTER_IP", default="").split(",") if ip.strip()]
 INVERTER_USER = os.getenv("INVERTER_USER")
 INVERTER_PASSWD = os.getenv("INVERTER_PASSWD")
 
@@ -45,6 +50,8 @@ DB_NAME = os.getenv("DB_NAME", default="solarpower")
 
 # other settings
 SAMPLE_TIME = int(os.getenv("SAMPLE_TIME", default=60))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", default=Influx.BATCH_SIZE))
+FLUSH_INTERVAL = int(os.getenv("FLUSH_INTERVAL", default=Influx.FLUSH_INTERVAL))
 DEBUG = os.getenv("DEBUG", default="False") == "True"
 
 
@@ -52,29 +59,80 @@ if DEBUG:
     logger.setLevel("DEBUG")
 
 
-def main():
-    mi300 = MI300(INVERTER_IP, INVERTER_USER, INVERTER_PASSWD, DEBUG)
-    influx = Influx(INFLUX_IP, INFLUX_PORT, INFLUX_USER, INFLUX_PASSWD, DB_NAME, DEBUG)
+async def sample(mi300: MI300) -> list:
+    """
+    Read one sample from the inverter, no data is returned if it is off-line.
+    """
+
+    await mi300.read_data()
+    return mi300.influx_data or []
+
+
+async def sample_all(inverters: List[MI300]) -> list:
+    """
+    Read one sample from all inverters concurrently.
+    A failing inverter is logged and does not affect the others.
+    """
+
+    results = await asyncio.gather(*(sample(mi300) for mi300 in inverters), return_exceptions=True)
+    data = []
+    for mi300, result in zip(inverters, results):
+        if isinstance(result, Exception):
+            logger.error(f"Reading inverter {mi300.ip} failed: {result}")
+        else:
+            data.extend(result)
+    return data
+
+
+async def write(influx: Influx, inverters: List[MI300], data: list) -> None:
+    """
+    Write the samples to the database and let the inverters know once their points have been written.
+    Errors are logged and not raised, so that a failed write does not affect the next samples.
+    """
+
+    try:
+        if await asyncio.to_thread(influx.write, data):
+            for mi300 in inverters:
+                mi300.confirm_written(data)
+    except Exception as e:
+        logger.error(f"Writing to the database failed: {e}")
+
+
+async def main():
+    if not INVERTER_IPS:
+        logger.error("No inverter configured. Set INVERTER_IP to the IP address of the inverter.")
+        sys.exit(1)
+
+    inverters = [MI300(ip, INVERTER_USER, INVERTER_PASSWD, DEBUG, 2 * SAMPLE_TIME) for ip in INVERTER_IPS]
+    influx = Influx(INFLUX_IP, INFLUX_PORT, INFLUX_USER, INFLUX_PASSWD, DB_NAME, DEBUG, BATCH_SIZE, FLUSH_INTERVAL)
+
+    # exit cleanly when docker stops the container so that buffered points are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # the database write of the previous sample runs in a thread while the next sample is fetched
+    write_task = None
 
     try:
         while True:
             try:
-                if mi300.is_reachable:
-                    mi300.read_data()
-                    if mi300.influx_data is not None:
-                        influx.write(mi300.influx_data)
-                else:
-                    logger.debug("Inverter is off-line.")
+                data, _ = await asyncio.gather(sample_all(inverters), write_task or asyncio.sleep(0))
+                # also hand over empty samples, so buffered points are flushed in time while the inverters are off
+                write_task = asyncio.create_task(write(influx, inverters, data))
 
             except Exception as e:
                 logger.error(e)
 
             finally:
-                time.sleep(SAMPLE_TIME)
+                await asyncio.sleep(SAMPLE_TIME)
 
-    except KeyboardInterrupt:
-        logger.warning("Program stopped by keyboard interrupt [CTRL_C] by user.")
+    finally:
+        if write_task is not None:
+            await write_task
+        await asyncio.gather(*(mi300.close() for mi300 in inverters))
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.warning("Program stopped by keyboard interrupt [CTRL_C] by user.")